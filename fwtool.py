@@ -1,13 +1,22 @@
 """ Tool to pack and unpack Insta360 X3 firmware files. """
 
+import errno
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from hashlib import md5
-from io import BytesIO
-from os import SEEK_END, SEEK_SET
+from mmap import ACCESS_READ, mmap
 from pathlib import Path
-from struct import calcsize, pack, unpack
+from struct import Struct
 from typing import BinaryIO, TypeVar
-from zlib import crc32
+
+try:
+    # ISA-L's crc32 uses PCLMULQDQ folding and is several times faster than zlib's on large segments
+    from isal.isal_zlib import crc32
+except ImportError:
+    from zlib import crc32
 
 MD5_LEN = 16
 TRAILER_FORMAT = "<I32s32s16s8sQ"
@@ -16,13 +25,36 @@ HEADER_SEG_FORMAT = "<II"
 HEADER_SEG_COUNT = 16
 HEADER_EXTRA_LEN = 0x180
 SEGHEADER_FORMAT = "<IIIIIII228s"
+ROMFS_FORMAT1 = "<II"
+ROMFS_ENTRY_FORMAT = "<64sIII"
 ROMFS_HEADER_LEN = 0xA000
 ROMFS_BLOCK_LEN = 2048
+COPY_CHUNK_LEN = 1 << 20
 
 HEADER_MAGIC = 0x8732DFE6
 SEGMENT_VERSION = 0x01000000
 SEGMENT_MAGIC = 0xA324EB90
 ROMFS_MAGIC = 0x66FC328A
+CRC32_POLY = 0xEDB88320
+
+TRAILER_STRUCT = Struct(TRAILER_FORMAT)
+HEADER_STRUCT1 = Struct(HEADER_FORMAT1)
+HEADER_SEG_STRUCT = Struct(HEADER_SEG_FORMAT)
+SEGHEADER_STRUCT = Struct(SEGHEADER_FORMAT)
+ROMFS_STRUCT1 = Struct(ROMFS_FORMAT1)
+ROMFS_ENTRY_STRUCT = Struct(ROMFS_ENTRY_FORMAT)
+
+TRAILER_LEN = TRAILER_STRUCT.size
+HEADER_LEN1 = HEADER_STRUCT1.size
+HEADER_SEG_LEN = HEADER_SEG_STRUCT.size
+HEADER_LEN = HEADER_LEN1 + HEADER_SEG_COUNT * HEADER_SEG_LEN + HEADER_EXTRA_LEN
+SEGHEADER_LEN = SEGHEADER_STRUCT.size
+ROMFS_LEN1 = ROMFS_STRUCT1.size
+ROMFS_ENTRY_LEN = ROMFS_ENTRY_STRUCT.size
+
+# shared all-zero buffer, large enough to cover any padding region in one go;
+# padding is validated against it and written from (zero-copy) slices of it
+ZEROS = bytes(ROMFS_HEADER_LEN)
 
 T = TypeVar("T")
 
@@ -33,33 +65,67 @@ def validate_eq(actual: T, expected: T, desc: str):
 
 
 def validate_padding(data: bytes):
-    if data != bytes(len(data)):
-        raise ValueError(f"padding of length {len(data)} was not all zero!")
-
-
-def _decode_trailer(file: BinaryIO) -> tuple[dict, bytes]:
+    # ZEROS.startswith is a plain memcmp, so this neither allocates a zero buffer per call
+    # nor falls back to the slow element-wise memoryview comparison
+    if len(data) <= len(ZEROS):
+        # the common case: a single C-level scan, without setting up a view or a loop
+        if not ZEROS.startswith(data):
+            raise ValueError(f"padding of length {len(data)} was not all zero!")
+        return
+
+    with memoryview(data) as view:
+        for i in range(0, len(view), len(ZEROS)):
+            if not ZEROS.startswith(view[i : i + len(ZEROS)]):
+                raise ValueError(f"padding of length {len(data)} was not all zero!")
+
+
+def _crc32_multmodp(a: int, b: int) -> int:
+    # multiply a and b modulo the (bit-reflected) crc32 polynomial, as in zlib's multmodp
+    p = 0
+    m = 1 << 31
+    while a:
+        if a & m:
+            p ^= b
+            a ^= m
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLY if b & 1 else b >> 1
+    return p
+
+
+def _crc32_x2n_table() -> list[int]:
+    # entry k is x^(2^k) modulo the crc32 polynomial
+    table = [1 << 30]
+    for _ in range(31):
+        table.append(_crc32_multmodp(table[-1], table[-1]))
+    return table
+
+
+CRC32_X2N_TABLE = _crc32_x2n_table()
+
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    # crc32 of the concatenation A + B, given crc1 = crc32(A), crc2 = crc32(B) and len2 = len(B).
+    # This is a port of zlib's crc32_combine, which Python's zlib module does not expose.
+    p = 1 << 31  # x^0 == 1
+    k = 3  # len2 counts bytes, i.e. multiples of x^8
+    while len2:
+        if len2 & 1:
+            p = _crc32_multmodp(CRC32_X2N_TABLE[k & 31], p)
+        len2 >>= 1
+        k += 1
+    return _crc32_multmodp(p, crc1) ^ crc2
+
+
+def _decode_trailer(data: memoryview) -> tuple[dict, int, bytes, bytes, bytes]:
     metadata = {}
 
-    tail_size = calcsize(TRAILER_FORMAT) + MD5_LEN
-    file.seek(0, SEEK_END)
-    total_size = file.tell()
-
-    ## read parts of the file
-    file.seek(0, SEEK_SET)
-    data = file.read(total_size - tail_size)
-    trailer = file.read(calcsize(TRAILER_FORMAT))
-    final_hash = file.read(MD5_LEN)
-    validate_eq(file.read(), b"", "trailing data")
-
-    ## compute hashes
-    m = md5(data)
-    h1 = m.digest()
-    m.update(trailer)
-    h2 = m.digest()
-    validate_eq(h2, final_hash, "final hash")
+    ## copy the trailer off the end of the file
+    body_size = len(data) - TRAILER_LEN - MD5_LEN
+    trailer = data[body_size : body_size + TRAILER_LEN].tobytes()
+    final_hash = data[body_size + TRAILER_LEN :].tobytes()
 
     ## decode trailer
-    body_size, product_name, version_name, body_hash, hw_id, hw_rev = unpack(TRAILER_FORMAT, trailer)
+    trailer_body_size, product_name, version_name, body_hash, hw_id, hw_rev = TRAILER_STRUCT.unpack(trailer)
     product_name = product_name.rstrip(b"\0").decode("latin1")
     version_name = version_name.rstrip(b"\0").decode("latin1")
     hw_id = hw_id.decode("latin1")
@@ -68,44 +134,52 @@ def _decode_trailer(file: BinaryIO) -> tuple[dict, bytes]:
     validate_eq(product_name, "onex3", "product name")
     validate_eq(hw_id, "WFNI3XNO", "hardware ID")
     validate_eq(hw_rev, 1, "hardware revision")
-    validate_eq(body_size, len(data), "size without trailer")
-    validate_eq(h1, body_hash, "hash without trailer")
+    validate_eq(trailer_body_size, body_size, "size without trailer")
 
     metadata["product_name"] = product_name
     metadata["version_name"] = version_name
     metadata["hw_id"] = hw_id
     metadata["hw_rev"] = hw_rev
 
-    return metadata, data
+    # the hashes are checked by the caller, once the body has been hashed while decoding it
+    return metadata, body_size, trailer, body_hash, final_hash
 
 
-def _decode_body(file: BinaryIO) -> tuple[dict, list[bytes]]:
+def _decode_body(body: memoryview, body_md5, verify_crc: bool = True) -> tuple[dict, bytes, list[tuple[int, int]]]:
+    # md5 and crc each chunk in the same pass; every slice of body is released before returning
     metadata: dict = {}
 
+    ## The header has a fixed size, so take all of it at once
+    header = body[:HEADER_LEN].tobytes()
+    validate_eq(len(header), HEADER_LEN, "header length")
+    body_md5.update(header)
+
     ## Decode first part of header
-    zero1, magic, body_crc, zero2 = unpack(HEADER_FORMAT1, file.read(calcsize(HEADER_FORMAT1)))
+    zero1, magic, body_crc, zero2 = HEADER_STRUCT1.unpack_from(header)
     validate_padding(zero1)
     validate_eq(magic, HEADER_MAGIC, "header magic")
     validate_padding(zero2)
 
     ## Decode segment list, remove empty segments
-    seg_infos = [unpack(HEADER_SEG_FORMAT, file.read(calcsize(HEADER_SEG_FORMAT))) for _ in range(HEADER_SEG_COUNT)]
+    seg_infos = list(HEADER_SEG_STRUCT.iter_unpack(header[HEADER_LEN1 : HEADER_LEN - HEADER_EXTRA_LEN]))
     while seg_infos and seg_infos[-1] == (0, 0):
         seg_infos.pop()
 
     ## We do not interpret the final part of the header;
     ## it appears to contain offsets and other information pertaining to the first segment (the ARM program).
-    extra = file.read(HEADER_EXTRA_LEN)
-    metadata["header_extra"] = extra.hex()
+    extra = header[HEADER_LEN - HEADER_EXTRA_LEN :]
 
     validate_eq(len(seg_infos), 6, "number of segments")
 
     ## Load and validate each segment
     metadata["segments"] = []
     segments = []
+    offset = HEADER_LEN
     running_crc = 0
     for seg_size, seg_crc in seg_infos:
-        sf_header = file.read(calcsize(SEGHEADER_FORMAT))
+        sf_header = body[offset : offset + SEGHEADER_LEN].tobytes()
+        offset += SEGHEADER_LEN
+        body_md5.update(sf_header)
         (
             sh_crc,
             sh_version,
@@ -115,19 +189,27 @@ def _decode_body(file: BinaryIO) -> tuple[dict, list[bytes]]:
             sh_extra2,
             sh_magic,
             sh_padding,
-        ) = unpack(SEGHEADER_FORMAT, sf_header)
+        ) = SEGHEADER_STRUCT.unpack(sf_header)
         validate_eq(sh_version, SEGMENT_VERSION, "segment version?")
         validate_eq(sh_magic, SEGMENT_MAGIC, "segment magic")
         validate_padding(sh_padding)
         if seg_size != 0:
-            validate_eq(seg_size, sh_size + calcsize(SEGHEADER_FORMAT), "segment size")
-
-        sf_data = file.read(sh_size)
-        running_crc = crc32(sf_header, running_crc)
-        running_crc = crc32(sf_data, running_crc)
-        sf_data_crc = crc32(sf_data)
-        validate_eq(sf_data_crc, sh_crc, "segment data crc")
-        validate_eq(0xFFFF_FFFF - running_crc, seg_crc, "segment running crc")
+            validate_eq(seg_size, sh_size + SEGHEADER_LEN, "segment size")
+
+        with body[offset : offset + sh_size] as sf_data:
+            validate_eq(len(sf_data), sh_size, "segment data length")
+            sf_data_crc = 0
+            for pos in range(0, sh_size, COPY_CHUNK_LEN):
+                with sf_data[pos : pos + COPY_CHUNK_LEN] as chunk:
+                    body_md5.update(chunk)
+                    if verify_crc:
+                        sf_data_crc = crc32(chunk, sf_data_crc)
+
+        ## The segment crcs are redundant with the trailer md5s, so they may be skipped
+        if verify_crc:
+            running_crc = crc32_combine(crc32(sf_header, running_crc), sf_data_crc, sh_size)
+            validate_eq(sf_data_crc, sh_crc, "segment data crc")
+            validate_eq(0xFFFF_FFFF - running_crc, seg_crc, "segment running crc")
 
         seg_metadata = {
             "version": sh_version,
@@ -136,38 +218,88 @@ def _decode_body(file: BinaryIO) -> tuple[dict, list[bytes]]:
             "extra2": sh_extra2,
         }
         metadata["segments"].append(seg_metadata)
-        segments.append(sf_data)
-
-    validate_eq(file.read(), b"", "trailing data")
-    validate_eq(running_crc, body_crc, "body crc")
-    return metadata, segments
-
-
-def decode_fw(file: BinaryIO, outdir: Path):
-    # replace file with the trailer-less file
-    trailer_metadata, body = _decode_trailer(file)
-    header_metadata, segments = _decode_body(BytesIO(body))
-
-    outdir.mkdir(parents=True, exist_ok=True)
-    with open(outdir / "metadata.json", "w") as outf:
-        json.dump({**trailer_metadata, **header_metadata}, outf)
+        segments.append((offset, sh_size))
+        offset += sh_size
+
+    validate_eq(offset, len(body), "size of decoded body")
+    if verify_crc:
+        validate_eq(running_crc, body_crc, "body crc")
+    return metadata, extra, segments
+
+
+# errnos with which copy_file_range reports that it cannot copy between the given files
+COPY_FILE_RANGE_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL}
+
+
+def _copy_range(file: BinaryIO, data: memoryview, offset: int, size: int, outf: BinaryIO):
+    # data is the contents of file; let the kernel copy the range where possible, so that it
+    # never passes through userspace, and write whatever is left from data
+    if hasattr(os, "copy_file_range"):
+        try:
+            while size:
+                copied = os.copy_file_range(file.fileno(), outf.fileno(), size, offset_src=offset)
+                if not copied:
+                    break
+                offset += copied
+                size -= copied
+        except OSError as e:
+            # only fall back to writing if copy_file_range is not supported here
+            if e.errno not in COPY_FILE_RANGE_UNSUPPORTED:
+                raise
+    outf.write(data[offset : offset + size])
+
+
+def _map_file(file: BinaryIO, min_size: int, desc: str) -> mmap:
+    # mmap refuses empty files, so check the size first
+    file_size = os.fstat(file.fileno()).st_size
+    if file_size < min_size:
+        raise ValueError(f"file of length {file_size} is too short to hold {desc}")
+    return mmap(file.fileno(), 0, access=ACCESS_READ)
+
+
+def decode_fw(file: BinaryIO, outdir: Path, verify_crc: bool = True):
+    ## map the file, so the body is decoded without reading it
+    with _map_file(file, TRAILER_LEN + MD5_LEN, "a trailer") as mm, memoryview(mm) as data:
+        trailer_metadata, body_size, trailer, body_hash, final_hash = _decode_trailer(data)
+
+        with data[:body_size] as body:
+            ## decode the body straight from the mapped file, hashing it as we go
+            body_md5 = md5()
+            header_metadata, header_extra, segments = _decode_body(body, body_md5, verify_crc)
+            validate_eq(body_md5.digest(), body_hash, "hash without trailer")
+            body_md5.update(trailer)
+            validate_eq(body_md5.digest(), final_hash, "final hash")
+
+            outdir.mkdir(parents=True, exist_ok=True)
+            with open(outdir / "metadata.json", "w") as outf:
+                json.dump({**trailer_metadata, **header_metadata}, outf)
+            with open(outdir / "header_extra.bin", "wb") as outf:
+                outf.write(header_extra)
+
+            for i, (seg_offset, seg_size) in enumerate(segments):
+                with open(outdir / f"f{i}.bin", "wb") as outf:
+                    _copy_range(file, body, seg_offset, seg_size, outf)
+
+
+def _encode_body(metadata: dict, header_extra: bytes, segment_data: list[bytes]) -> bytearray:
+    validate_eq(len(metadata["segments"]), len(segment_data), "number of segments")
+    validate_eq(len(header_extra), HEADER_EXTRA_LEN, "header extra length")
 
-    for i, seg in enumerate(segments):
-        with open(outdir / f"f{i}.bin", "wb") as outf:
-            outf.write(seg)
+    ## lay out the whole body up front so that it can be built in a single allocation
+    body = bytearray(HEADER_LEN + sum(SEGHEADER_LEN + len(sf_data) for sf_data in segment_data))
 
+    ## the segment crcs are the expensive part, and are independent of each other (crc32 releases the GIL)
+    with ThreadPoolExecutor() as pool:
+        sf_data_crcs = list(pool.map(crc32, segment_data))
 
-def _encode_body(metadata: dict, segment_data: list[bytes]) -> bytes:
     seg_infos = []
-
-    body = bytearray()
     running_crc = 0
-    validate_eq(len(metadata["segments"]), len(segment_data), "number of segments")
-
-    for seg_md, sf_data in zip(metadata["segments"], segment_data):
-        sf_header = pack(
-            SEGHEADER_FORMAT,
-            crc32(sf_data),
+    offset = HEADER_LEN
+    for seg_md, sf_data, sf_data_crc in zip(metadata["segments"], segment_data, sf_data_crcs):
+        SEGHEADER_STRUCT.pack_into(
+            body,
+            offset,
+            sf_data_crc,
             seg_md["version"],
             seg_md["date"],
             len(sf_data),
@@ -176,28 +308,30 @@ def _encode_body(metadata: dict, segment_data: list[bytes]) -> bytes:
             SEGMENT_MAGIC,
             b"",
         )
-        running_crc = crc32(sf_header, running_crc)
-        running_crc = crc32(sf_data, running_crc)
-        body += sf_header
-        body += sf_data
-        seg_infos.append([len(sf_header) + len(sf_data), 0xFFFF_FFFF - running_crc])
-
-    header = pack(HEADER_FORMAT1, b"", HEADER_MAGIC, running_crc, b"")
+        running_crc = crc32(body[offset : offset + SEGHEADER_LEN], running_crc)
+        running_crc = crc32_combine(running_crc, sf_data_crc, len(sf_data))
+        offset += SEGHEADER_LEN
+        body[offset : offset + len(sf_data)] = sf_data
+        offset += len(sf_data)
+        seg_infos.append([SEGHEADER_LEN + len(sf_data), 0xFFFF_FFFF - running_crc])
+
+    HEADER_STRUCT1.pack_into(body, 0, b"", HEADER_MAGIC, running_crc, b"")
     # zero out the size of the last segment in the header
     seg_infos[-1][0] = 0
     while len(seg_infos) < HEADER_SEG_COUNT:
         seg_infos.append([0, 0])
+    offset = HEADER_LEN1
     for i in range(HEADER_SEG_COUNT):
-        header += pack(HEADER_SEG_FORMAT, *seg_infos[i])
-    header += bytes.fromhex(metadata["header_extra"])
+        HEADER_SEG_STRUCT.pack_into(body, offset, *seg_infos[i])
+        offset += HEADER_SEG_LEN
+    body[offset:HEADER_LEN] = header_extra
 
-    return header + bytes(body)
+    return body
 
 
 def _encode_trailer(metadata: dict, body: bytes) -> bytes:
     m = md5(body)
-    trailer = pack(
-        TRAILER_FORMAT,
+    trailer = TRAILER_STRUCT.pack(
         len(body),
         metadata["product_name"].encode(),
         metadata["version_name"].encode(),
@@ -209,67 +343,137 @@ def _encode_trailer(metadata: dict, body: bytes) -> bytes:
     return trailer + m.digest()
 
 
-def encode_fw(fwdir: Path) -> bytes:
+def encode_fw(fwdir: Path) -> bytearray:
     with open(fwdir / "metadata.json", "r") as inf:
         metadata = json.load(inf)
 
+    if (fwdir / "header_extra.bin").is_file():
+        with open(fwdir / "header_extra.bin", "rb") as inf:
+            header_extra = inf.read()
+    else:
+        # directories unpacked by older versions of this tool store it as hex in metadata.json
+        header_extra = bytes.fromhex(metadata["header_extra"])
+
     segment_data = []
     for i in range(len(metadata["segments"])):
         with open(fwdir / f"f{i}.bin", "rb") as inf:
             segment_data.append(inf.read())
 
-    body = _encode_body(metadata, segment_data)
-    trailer = _encode_trailer(metadata, body)
+    body = _encode_body(metadata, header_extra, segment_data)
+    body += _encode_trailer(metadata, body)
 
-    return body + trailer
+    return body
 
 
 def decode_romfs(file: BinaryIO, outdir: Path):
-    magic, subf_count = unpack("<II", file.read(8))
-    validate_eq(magic, ROMFS_MAGIC, "romfs magic")
-
-    subf_files = [unpack("<64sIII", file.read(76)) for _ in range(subf_count)]
-    for subf_fn, subf_size, subf_offset, subf_hash in subf_files:
-        subf_fn = subf_fn.rstrip(b"\0").decode()
-        padding = file.read(subf_offset - file.tell())
-        validate_padding(padding)
-        validate_eq(subf_offset % ROMFS_BLOCK_LEN, 0, "file must be block-aligned")
-        subf_data = file.read(subf_size)
-
-        validate_eq(crc32(subf_data), subf_hash, "romfs file crc")
-        with open(outdir / subf_fn, "wb") as outf:
-            outf.write(subf_data)
-
-    padding = file.read()
-    validate_padding(padding)
+    with _map_file(file, ROMFS_LEN1, "a romfs header") as mm, memoryview(mm) as view:
+        magic, subf_count = ROMFS_STRUCT1.unpack_from(view)
+        validate_eq(magic, ROMFS_MAGIC, "romfs magic")
+
+        offset = ROMFS_LEN1
+        table_end = offset + subf_count * ROMFS_ENTRY_LEN
+        subf_files = list(ROMFS_ENTRY_STRUCT.iter_unpack(view[offset:table_end]))
+        validate_eq(len(subf_files), subf_count, "number of romfs entries")
+        offset = table_end
+        for subf_fn, subf_size, subf_offset, subf_hash in subf_files:
+            subf_fn = subf_fn.rstrip(b"\0").decode()
+            # slicing would silently give empty padding here, so out-of-order or overlapping files must be caught
+            if subf_offset < offset:
+                raise ValueError(
+                    f"romfs file {subf_fn} at offset {subf_offset} overlaps the data before it at {offset}"
+                )
+            with view[offset:subf_offset] as padding:
+                validate_padding(padding)
+            validate_eq(subf_offset % ROMFS_BLOCK_LEN, 0, "file must be block-aligned")
+            with view[subf_offset : subf_offset + subf_size] as subf_data:
+                offset = subf_offset + len(subf_data)
+
+                validate_eq(crc32(subf_data), subf_hash, "romfs file crc")
+                with open(outdir / subf_fn, "wb") as outf:
+                    outf.write(subf_data)
+
+        with view[offset:] as padding:
+            validate_padding(padding)
 
     with open(outdir / "__filelist__.txt", "w") as outf:
         for subf_fn, *_ in subf_files:
             print(subf_fn.rstrip(b"\0").decode(), file=outf)
 
 
-def encode_romfs(indir: Path) -> bytes:
+def _write_at(outf: BinaryIO, data: memoryview, offset: int):
+    # os.pwrite does not use the file position, so it is safe to call from several threads at once
+    if hasattr(os, "pwrite"):
+        while data:
+            written = os.pwrite(outf.fileno(), data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        outf.seek(offset)
+        outf.write(data)
+
+
+def _copy_romfs_file(outf: BinaryIO, path: Path, size: int, offset: int) -> int:
+    # copy the first size bytes of path to offset in outf, followed by its block padding, and return their crc
+    buf = memoryview(bytearray(min(size, COPY_CHUNK_LEN)))
+    crc = 0
+    with open(path, "rb") as inf:
+        for pos in range(0, size, COPY_CHUNK_LEN):
+            chunk = buf[: min(COPY_CHUNK_LEN, size - pos)]
+            validate_eq(inf.readinto(chunk), len(chunk), f"bytes read from {path} at {pos}")
+            crc = crc32(chunk, crc)
+            _write_at(outf, chunk, offset + pos)
+
+    # note that we add padding even when we are already at a multiple of the block size
+    _write_at(outf, memoryview(ZEROS)[: ROMFS_BLOCK_LEN - (size % ROMFS_BLOCK_LEN)], offset + size)
+    return crc
+
+
+def encode_romfs(indir: Path, fwfile: Path):
     # We use the filelist in order to produce a romfs with the files in the same order as the original firmware
     filelist = indir / "__filelist__.txt"
     if filelist.is_file():
-        filenames = [row.strip() for row in open(filelist)]
+        filenames = [row.strip() for row in filelist.read_text().splitlines()]
     else:
         print("Warning: __filelist__.txt not found; packing all files in the directory")
-        filenames = list(indir.iterdir())
-
-    header = bytearray(pack("<II", ROMFS_MAGIC, len(filenames)))
-    data = bytearray()
-    for filename in filenames:
-        with open(indir / filename, "rb") as inf:
-            subf_data = inf.read()
-
-        header += pack("<64sIII", filename.encode(), len(subf_data), len(data) + ROMFS_HEADER_LEN, crc32(subf_data))
-        data += subf_data
-        # note that we add padding even when we are already at a multiple of the block size
-        data += bytes(ROMFS_BLOCK_LEN - (len(data) % ROMFS_BLOCK_LEN))
-
-    assert len(header) < ROMFS_HEADER_LEN, "Too many files in the romfs"
-    return header + bytes(ROMFS_HEADER_LEN - len(header)) + data
+        filenames = sorted(path.name for path in indir.iterdir() if path.is_file())
+
+    header_len = ROMFS_LEN1 + len(filenames) * ROMFS_ENTRY_LEN
+    assert header_len < ROMFS_HEADER_LEN, "Too many files in the romfs"
+
+    ## lay out the whole romfs up front from the file sizes
+    paths = [indir / filename for filename in filenames]
+    for path in paths:
+        if not path.is_file():
+            raise FileNotFoundError(f"romfs input {path} is not a regular file")
+    sizes = [path.stat().st_size for path in paths]
+    offsets = []
+    offset = ROMFS_HEADER_LEN
+    for size in sizes:
+        offsets.append(offset)
+        offset += (size // ROMFS_BLOCK_LEN + 1) * ROMFS_BLOCK_LEN
+
+    ## only truncate the output once all of the inputs have been checked
+    with open(fwfile, "wb") as outf:
+        ## copy the files into place and crc them; large files are copied on a pool if pwrite is available
+        copy = partial(_copy_romfs_file, outf)
+        parallel = hasattr(os, "pwrite") and max(sizes, default=0) >= COPY_CHUNK_LEN
+        crcs: list = [None] * len(paths)
+        futures = {}
+        with ThreadPoolExecutor() if parallel else nullcontext() as pool:
+            for i, (path, size, offset) in enumerate(zip(paths, sizes, offsets)):
+                if parallel and size >= COPY_CHUNK_LEN:
+                    futures[i] = pool.submit(copy, path, size, offset)
+                else:
+                    crcs[i] = copy(path, size, offset)
+            for i, future in futures.items():
+                crcs[i] = future.result()
+
+        ## the header is written last, once all of the crcs are known
+        header = bytearray(ROMFS_HEADER_LEN)
+        ROMFS_STRUCT1.pack_into(header, 0, ROMFS_MAGIC, len(filenames))
+        for i, (filename, size, offset, crc) in enumerate(zip(filenames, sizes, offsets, crcs)):
+            ROMFS_ENTRY_STRUCT.pack_into(header, ROMFS_LEN1 + ROMFS_ENTRY_LEN * i, filename.encode(), size, offset, crc)
+        _write_at(outf, memoryview(header), 0)
 
 
 def parse_args(argv):
@@ -279,6 +483,11 @@ def parse_args(argv):
     parser.add_argument("operation", help="Operation", choices=("pack", "unpack", "pack-romfs", "unpack-romfs"))
     parser.add_argument("fwfile", help="Packed firmware file", type=Path)
     parser.add_argument("fwdir", help="Unpacked directory", type=Path)
+    parser.add_argument(
+        "--skip-crc",
+        help="Skip the segment CRC checks when unpacking firmware (the MD5 checks still cover the whole file)",
+        action="store_true",
+    )
 
     args = parser.parse_args(argv)
     return args
@@ -288,17 +497,17 @@ def main(argv):
     args = parse_args(argv)
 
     if args.operation == "unpack":
-        decode_fw(open(args.fwfile, "rb"), args.fwdir)
+        with open(args.fwfile, "rb") as inf:
+            decode_fw(inf, args.fwdir, verify_crc=not args.skip_crc)
     elif args.operation == "pack":
         data = encode_fw(args.fwdir)
         with open(args.fwfile, "wb") as outf:
             outf.write(data)
     elif args.operation == "unpack-romfs":
-        decode_romfs(open(args.fwfile, "rb"), args.fwdir)
+        with open(args.fwfile, "rb") as inf:
+            decode_romfs(inf, args.fwdir)
     elif args.operation == "pack-romfs":
-        data = encode_romfs(args.fwdir)
-        with open(args.fwfile, "wb") as outf:
-            outf.write(data)
+        encode_romfs(args.fwdir, args.fwfile)
 
 
 if __name__ == "__main__":